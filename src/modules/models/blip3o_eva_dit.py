@@ -11,13 +11,26 @@ Key features:
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from typing import Optional, Dict, Any, Tuple, Union
+from typing import Optional, Dict, Any, Tuple, Union, List, Literal
+import os
 import math
+import functools
 import logging
+from contextlib import nullcontext
 from transformers import PreTrainedModel, PretrainedConfig
 
 logger = logging.getLogger(__name__)
 
+# F.scaled_dot_product_attention accepts enable_gqa from PyTorch 2.5
+_SDPA_SUPPORTS_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
+# F.rms_norm (fused kernel) is available from PyTorch 2.4
+_HAS_FUSED_RMS_NORM = hasattr(F, "rms_norm")
+
+# denoise only captures a CUDA graph when enough model calls amortize the warm-up + capture
+CUDA_GRAPH_MIN_MODEL_CALLS = 8
+# Captured graphs kept per model (each holds its own memory pool)
+CUDA_GRAPH_CACHE_SIZE = 4
+
 
 class UniversalDiTConfig(PretrainedConfig):
     """Configuration for Universal EVA/CLIP Denoising DiT model"""
@@ -43,6 +56,8 @@ class UniversalDiTConfig(PretrainedConfig):
         use_gradient_checkpointing: bool = False,
         training_mode: str = "patch_only",
         rope_theta: float = 10000.0,
+        use_torch_compile: bool = False,  # Compile whole DiT blocks
+        compile_kernels: bool = True,  # Compile fused helper kernels (False disables torch.compile process-wide)
         # Flow matching parameters
         prediction_type: str = "velocity",
         **kwargs
@@ -80,9 +95,100 @@ class UniversalDiTConfig(PretrainedConfig):
         self.use_gradient_checkpointing = use_gradient_checkpointing
         self.training_mode = training_mode
         self.rope_theta = rope_theta
+        self.use_torch_compile = use_torch_compile
+        self.compile_kernels = compile_kernels
         self.prediction_type = prediction_type
 
 
+def _compile_error_types() -> Tuple[type, ...]:
+    """Exception types raised when dynamo/inductor cannot compile (not runtime errors)"""
+    error_types = []
+    try:
+        from torch._dynamo import exc as dynamo_exc
+        error_types += [
+            getattr(dynamo_exc, name) for name in ("BackendCompilerFailed", "Unsupported")
+            if hasattr(dynamo_exc, name)
+        ]
+    except ImportError:
+        pass
+    try:
+        from torch._inductor.exc import InductorError
+        error_types.append(InductorError)
+    except ImportError:
+        pass
+    return tuple(error_types)
+
+
+_COMPILE_ERRORS = _compile_error_types()
+
+
+# Process-wide torch.compile switch for maybe_compile helpers and block compilation
+# (also settable with BLIP3O_TORCH_COMPILE=0 or set_torch_compile_enabled)
+_COMPILE_SETTINGS = {"enabled": os.environ.get("BLIP3O_TORCH_COMPILE", "1") != "0"}
+
+
+def set_torch_compile_enabled(enabled: bool):
+    """Enable/disable torch.compile for all maybe_compile helpers and DiT block compilation"""
+    _COMPILE_SETTINGS["enabled"] = enabled
+
+
+def _dynamo_supported() -> bool:
+    """Whether torch.compile can be used on this platform/Python version"""
+    if not hasattr(torch, "compile"):
+        return False
+    try:
+        import torch._dynamo
+        is_supported = getattr(torch._dynamo, "is_dynamo_supported", None)
+        return is_supported() if is_supported is not None else True
+    except Exception:
+        return False
+
+
+def maybe_compile(fn=None, **compile_kwargs):
+    """torch.compile `fn`, falling back to eager if compilation is unavailable or fails"""
+    if fn is None:
+        return lambda f: maybe_compile(f, **compile_kwargs)
+    if not _dynamo_supported():
+        return fn
+    
+    try:
+        compiled_fn = torch.compile(fn, **compile_kwargs)
+    except RuntimeError as e:
+        # Raised at construction on unsupported setups (e.g. Python 3.12 with torch 2.1, Windows)
+        logger.warning(f"torch.compile unavailable for {fn.__name__}, using eager mode: {e}")
+        return fn
+    state = {"failed": False}
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _COMPILE_SETTINGS["enabled"] and not state["failed"]:
+            try:
+                return compiled_fn(*args, **kwargs)
+            except _COMPILE_ERRORS as e:
+                # Only compilation failures switch to eager; runtime errors propagate
+                state["failed"] = True
+                logger.warning(f"torch.compile failed for {fn.__name__}, using eager mode: {e}")
+        return fn(*args, **kwargs)
+    
+    return wrapper
+
+
+@maybe_compile(dynamic=True)
+def rms_norm(hidden_states: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    """RMS normalization, using the fused F.rms_norm kernel when available"""
+    if _HAS_FUSED_RMS_NORM:
+        return F.rms_norm(hidden_states, (hidden_states.shape[-1],), weight, eps)
+    if hidden_states.dtype == torch.bfloat16:
+        # bf16 has fp32's exponent range: accumulate the mean in fp32 without an fp32 copy of the input
+        variance = hidden_states.pow(2).mean(-1, keepdim=True, dtype=torch.float32)
+        return weight * (hidden_states * torch.rsqrt(variance + eps).to(hidden_states.dtype))
+    input_dtype = hidden_states.dtype
+    hidden_states = hidden_states.to(torch.float32)
+    variance = hidden_states.pow(2).mean(-1, keepdim=True)
+    hidden_states = hidden_states * torch.rsqrt(variance + eps)
+    return weight * hidden_states.to(input_dtype)
+
+
 class RMSNorm(nn.Module):
     """RMS Normalization"""
     def __init__(self, hidden_size: int, eps: float = 1e-6):
@@ -91,15 +197,11 @@ class RMSNorm(nn.Module):
         self.variance_epsilon = eps
 
     def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
-        input_dtype = hidden_states.dtype
-        hidden_states = hidden_states.to(torch.float32)
-        variance = hidden_states.pow(2).mean(-1, keepdim=True)
-        hidden_states = hidden_states * torch.rsqrt(variance + self.variance_epsilon)
-        return self.weight * hidden_states.to(input_dtype)
+        return rms_norm(hidden_states, self.weight, self.variance_epsilon)
 
 
 class RotaryEmbedding(nn.Module):
-    """Rotary Position Embedding"""
+    """Rotary Position Embedding with precomputed cos/sin caches"""
     def __init__(self, dim: int, max_position_embeddings: int = 256, base: float = 10000):
         super().__init__()
         self.dim = dim
@@ -107,35 +209,74 @@ class RotaryEmbedding(nn.Module):
         self.base = base
         inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2).float() / self.dim))
         self.register_buffer("inv_freq", inv_freq, persistent=False)
+        self._set_cos_sin_cache(max_position_embeddings, device=inv_freq.device)
+
+    def _set_cos_sin_cache(self, seq_len: int, device: torch.device):
+        self.max_seq_len_cached = seq_len
+        t = torch.arange(seq_len, device=device, dtype=torch.float32)
+        freqs = torch.outer(t, self.inv_freq.to(device))
+        emb = torch.cat((freqs, freqs), dim=-1)
+        # [1, 1, max_pos, dim] broadcasts over batch and heads
+        self.register_buffer("cos_cached", emb.cos()[None, None, :, :], persistent=False)
+        self.register_buffer("sin_cached", emb.sin()[None, None, :, :], persistent=False)
+        # Per-(dtype, device) casts of the caches, filled lazily in forward
+        self._cast_cache = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        if self.cos_cached.dtype != torch.float32:
+            # Dtype casts would degrade the tables: rebuild them in fp32 on the new device
+            device = self.cos_cached.device
+            self.inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, device=device).float() / self.dim))
+            self._set_cos_sin_cache(self.max_seq_len_cached, device=device)
+        else:
+            # Drop casts made for the previous device/dtype so they are not kept alive
+            self._cast_cache = {}
+        return self
 
     def forward(self, x: torch.Tensor, seq_len: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         if seq_len is None:
             seq_len = x.shape[1]
         
-        t = torch.arange(seq_len, device=x.device, dtype=torch.float32)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-        emb = torch.cat((freqs, freqs), dim=-1)
-        return emb.cos().unsqueeze(0), emb.sin().unsqueeze(0)
+        # Sequences longer than max_position_embeddings (e.g. 257 tokens with CLS) grow the cache once
+        if seq_len > self.max_seq_len_cached:
+            self._set_cos_sin_cache(seq_len, device=x.device)
+        
+        key = (x.dtype, x.device)
+        if key not in self._cast_cache:
+            self._cast_cache[key] = (
+                self.cos_cached.to(device=x.device, dtype=x.dtype),
+                self.sin_cached.to(device=x.device, dtype=x.dtype),
+            )
+        cos, sin = self._cast_cache[key]
+        return cos[..., :seq_len, :], sin[..., :seq_len, :]
+
+
+def rotate_half(x: torch.Tensor) -> torch.Tensor:
+    """Rotate half the hidden dims of the input"""
+    x1 = x[..., : x.shape[-1] // 2]
+    x2 = x[..., x.shape[-1] // 2 :]
+    return torch.cat((-x2, x1), dim=-1)
 
 
+@maybe_compile(dynamic=True, fullgraph=True)
 def apply_rotary_pos_emb(q: torch.Tensor, k: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor):
-    """Apply rotary position embedding"""
-    def rotate_half(x):
-        x1 = x[..., : x.shape[-1] // 2]
-        x2 = x[..., x.shape[-1] // 2 :]
-        return torch.cat((-x2, x1), dim=-1)
-
-    q_embed = (q * cos) + (rotate_half(q) * sin)
-    k_embed = (k * cos) + (rotate_half(k) * sin)
+    """Apply rotary position embedding to Q and K in one compiled (fused) kernel"""
+    q_embed = torch.addcmul(q * cos, rotate_half(q), sin)
+    k_embed = torch.addcmul(k * cos, rotate_half(k), sin)
     return q_embed, k_embed
 
 
 class TimestepEmbedder(nn.Module):
     """Timestep embedding for flow matching"""
-    def __init__(self, hidden_size: int, frequency_embedding_size: int = 256):
+    def __init__(self, hidden_size: int, frequency_embedding_size: int = 256, max_period: int = 10000):
         super().__init__()
         self.hidden_size = hidden_size
         self.frequency_embedding_size = frequency_embedding_size
+        self.max_period = max_period
+        
+        # Sinusoidal frequency table, built once and moved with the module
+        self.register_buffer("freqs", self._build_freqs(torch.device("cpu")), persistent=False)
         
         self.mlp = nn.Sequential(
             nn.Linear(frequency_embedding_size, hidden_size),
@@ -147,32 +288,42 @@ class TimestepEmbedder(nn.Module):
         
         self._init_weights()
 
+    def _build_freqs(self, device: torch.device) -> torch.Tensor:
+        half = self.frequency_embedding_size // 2
+        exponent = torch.arange(start=0, end=half, dtype=torch.float32, device=device) / half
+        return torch.exp(-math.log(self.max_period) * exponent)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # Dtype casts (e.g. .to(torch.bfloat16)) would also cast the table: rebuild it in fp32
+        if self.freqs.dtype != torch.float32:
+            self.freqs = self._build_freqs(self.freqs.device)
+        return self
+
     def _init_weights(self):
         for module in self.mlp:
             if isinstance(module, nn.Linear):
                 nn.init.xavier_uniform_(module.weight, gain=0.5)
                 nn.init.zeros_(module.bias)
 
-    @staticmethod
-    def timestep_embedding(t: torch.Tensor, dim: int, max_period: int = 10000) -> torch.Tensor:
-        half = dim // 2
-        freqs = torch.exp(-math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half).to(t.device)
-        args = t[:, None].float() * freqs[None]
+    def timestep_embedding(self, t: torch.Tensor) -> torch.Tensor:
+        args = t[:, None].float() * self.freqs[None]
         embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
-        if dim % 2:
+        if self.frequency_embedding_size % 2:
             embedding = torch.cat([embedding, torch.zeros_like(embedding[:, :1])], dim=-1)
         return embedding
 
     def forward(self, t: torch.Tensor) -> torch.Tensor:
-        t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
+        t_freq = self.timestep_embedding(t)
         return self.mlp(t_freq)
 
 
 class UniversalAttention(nn.Module):
     """Multi-head attention supporting different input/conditioning dimensions"""
-    def __init__(self, config: UniversalDiTConfig):
+    def __init__(self, config: UniversalDiTConfig, is_cross_attention: bool = False):
         super().__init__()
         self.config = config
+        self.is_cross_attention = is_cross_attention
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -180,11 +331,25 @@ class UniversalAttention(nn.Module):
         self.num_key_value_groups = self.num_heads // self.num_key_value_heads
         
         assert self.hidden_size % self.num_heads == 0
+        if self.head_dim % 8 != 0 or self.head_dim > 256:
+            logger.warning(
+                f"head_dim={self.head_dim} is not FlashAttention-friendly "
+                f"(needs a multiple of 8, <= 256); SDPA will fall back to slower kernels"
+            )
         
-        # Standard attention projections
-        self.q_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=False)
-        self.k_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=False)
-        self.v_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=False)
+        # Attention projections: separate Q/K/V for cross-attention (different inputs),
+        # one packed QKV GEMM for self-attention
+        self.qkv_split_sizes = [
+            self.num_heads * self.head_dim,
+            self.num_key_value_heads * self.head_dim,
+            self.num_key_value_heads * self.head_dim,
+        ]
+        if is_cross_attention:
+            self.q_proj = nn.Linear(self.hidden_size, self.qkv_split_sizes[0], bias=False)
+            self.k_proj = nn.Linear(self.hidden_size, self.qkv_split_sizes[1], bias=False)
+            self.v_proj = nn.Linear(self.hidden_size, self.qkv_split_sizes[2], bias=False)
+        else:
+            self.qkv_proj = nn.Linear(self.hidden_size, sum(self.qkv_split_sizes), bias=False)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
         
         # RoPE
@@ -194,85 +359,118 @@ class UniversalAttention(nn.Module):
             base=config.rope_theta,
         )
         
-        self.dropout = nn.Dropout(config.attention_dropout)
         self._init_weights()
     
     def _init_weights(self):
-        for module in [self.q_proj, self.k_proj, self.v_proj]:
-            nn.init.xavier_uniform_(module.weight, gain=0.8)
+        if self.is_cross_attention:
+            for module in [self.q_proj, self.k_proj, self.v_proj]:
+                nn.init.xavier_uniform_(module.weight, gain=0.8)
+        else:
+            # Initialize the Q, K and V blocks separately, as if they were separate projections
+            for weight in self.qkv_proj.weight.split(self.qkv_split_sizes, dim=0):
+                nn.init.xavier_uniform_(weight, gain=0.8)
         nn.init.xavier_uniform_(self.o_proj.weight, gain=0.5)
     
+    def _split_heads(self, states: torch.Tensor, num_heads: int) -> torch.Tensor:
+        """[B, N, num_heads * head_dim] -> [B, num_heads, N, head_dim]"""
+        bsz, seq_len, _ = states.size()
+        return states.view(bsz, seq_len, num_heads, self.head_dim).transpose(1, 2)
+    
+    def project_key_value(self, key_value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Project cross-attention K/V and reshape to [B, num_kv_heads, N, head_dim] (pre-RoPE)"""
+        key_states = self._split_heads(self.k_proj(key_value_states), self.num_key_value_heads)
+        value_states = self._split_heads(self.v_proj(key_value_states), self.num_key_value_heads)
+        return key_states, value_states
+    
     def forward(
         self,
         hidden_states: torch.Tensor,
         key_value_states: Optional[torch.Tensor] = None,
         attention_mask: Optional[torch.Tensor] = None,
+        cached_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # From project_key_value()
     ) -> torch.Tensor:
         bsz, q_len, _ = hidden_states.size()
         
-        if key_value_states is not None:
-            # Cross-attention
-            kv_seq_len = key_value_states.shape[1]
-            query_states = self.q_proj(hidden_states)
-            key_states = self.k_proj(key_value_states)
-            value_states = self.v_proj(key_value_states)
+        if self.is_cross_attention:
+            query_states = self._split_heads(self.q_proj(hidden_states), self.num_heads)
+            if cached_kv is not None:
+                # Precomputed K/V
+                key_states, value_states = cached_kv
+            else:
+                kv_input = key_value_states if key_value_states is not None else hidden_states
+                key_states, value_states = self.project_key_value(kv_input)
         else:
-            # Self-attention
-            kv_seq_len = q_len
-            query_states = self.q_proj(hidden_states)
-            key_states = self.k_proj(hidden_states)
-            value_states = self.v_proj(hidden_states)
-        
-        # Reshape for multi-head attention
-        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-        key_states = key_states.view(bsz, kv_seq_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
-        value_states = value_states.view(bsz, kv_seq_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+            if key_value_states is not None or cached_kv is not None:
+                raise ValueError("Self-attention module does not accept key_value_states or cached_kv")
+            # Self-attention: single packed QKV GEMM
+            query_states, key_states, value_states = self.qkv_proj(hidden_states).split(
+                self.qkv_split_sizes, dim=-1
+            )
+            query_states = self._split_heads(query_states, self.num_heads)
+            key_states = self._split_heads(key_states, self.num_key_value_heads)
+            value_states = self._split_heads(value_states, self.num_key_value_heads)
+        kv_seq_len = key_states.shape[2]
         
         # Apply RoPE
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
         
-        # Repeat k/v heads if needed
-        key_states = key_states.repeat_interleave(self.num_key_value_groups, dim=1)
-        value_states = value_states.repeat_interleave(self.num_key_value_groups, dim=1)
-        
-        # Attention computation
-        scale = (self.head_dim ** -0.5) * 0.8
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) * scale
-        
-        if attention_mask is not None:
-            attn_weights = attn_weights + attention_mask
+        # Grouped-query attention: SDPA broadcasts K/V heads natively when supported
+        if not _SDPA_SUPPORTS_GQA:
+            key_states = key_states.repeat_interleave(self.num_key_value_groups, dim=1)
+            value_states = value_states.repeat_interleave(self.num_key_value_groups, dim=1)
+        gqa_kwargs = {"enable_gqa": True} if _SDPA_SUPPORTS_GQA else {}
         
-        attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_weights = self.dropout(attn_weights)
+        # SDPA's default dispatch already prefers FlashAttention, then memory-efficient, then math
+        attn_output = F.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.config.attention_dropout if self.training else 0.0,
+            scale=(self.head_dim ** -0.5) * 0.8,
+            is_causal=False,
+            **gqa_kwargs,
+        )
         
-        attn_output = torch.matmul(attn_weights, value_states)
-        attn_output = attn_output.transpose(1, 2).contiguous().view(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.hidden_size)
         
         return self.o_proj(attn_output)
 
 
+@maybe_compile(dynamic=True)
+def swiglu(gate: torch.Tensor, up: torch.Tensor) -> torch.Tensor:
+    """SiLU-gated product, fused into one elementwise kernel"""
+    return F.silu(gate) * up
+
+
 class UniversalMLP(nn.Module):
     """Feed-forward network"""
     def __init__(self, config: UniversalDiTConfig):
         super().__init__()
-        self.gate_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
-        self.up_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
+        self.intermediate_size = config.intermediate_size
+        # Gate and up projections packed into one GEMM
+        self.gate_up_proj = nn.Linear(config.hidden_size, 2 * config.intermediate_size, bias=False)
         self.down_proj = nn.Linear(config.intermediate_size, config.hidden_size, bias=False)
-        self.act_fn = nn.SiLU()
         self.dropout = nn.Dropout(config.dropout_prob)
         
         self._init_weights()
 
     def _init_weights(self):
-        nn.init.xavier_uniform_(self.gate_proj.weight, gain=0.8)
-        nn.init.xavier_uniform_(self.up_proj.weight, gain=0.8)
+        # Initialize gate and up halves separately to keep the per-projection xavier scale
+        nn.init.xavier_uniform_(self.gate_up_proj.weight[: self.intermediate_size], gain=0.8)
+        nn.init.xavier_uniform_(self.gate_up_proj.weight[self.intermediate_size :], gain=0.8)
         nn.init.xavier_uniform_(self.down_proj.weight, gain=0.5)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        gate = self.act_fn(self.gate_proj(x))
-        up = self.up_proj(x)
-        return self.dropout(self.down_proj(gate * up))
+        gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.dropout(self.down_proj(swiglu(gate, up)))
+
+
+@maybe_compile(dynamic=True)
+def modulate(normalized: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    """Apply AdaLN shift/scale modulation as a single fused elementwise op"""
+    return torch.addcmul(shift, normalized, 1 + scale)
 
 
 class AdaLN(nn.Module):
@@ -289,17 +487,14 @@ class AdaLN(nn.Module):
         nn.init.zeros_(self.adaLN_modulation[-1].bias)
 
     def forward(self, x: torch.Tensor, conditioning: torch.Tensor) -> torch.Tensor:
-        if conditioning.dim() == 2:
-            conditioning = conditioning.unsqueeze(1)
-        
+        # Project the [B, H] conditioning (or per-token [B, N, H]) before broadcasting over tokens
         shift, scale = self.adaLN_modulation(conditioning).chunk(2, dim=-1)
         
-        if shift.shape[1] == 1 and x.shape[1] > 1:
-            shift = shift.expand(-1, x.shape[1], -1)
-            scale = scale.expand(-1, x.shape[1], -1)
+        if shift.dim() == 2:
+            shift = shift[:, None, :]
+            scale = scale[:, None, :]
         
-        normalized = self.norm(x)
-        return normalized * (1 + scale) + shift
+        return modulate(self.norm(x), shift, scale)
 
 
 class UniversalDiTBlock(nn.Module):
@@ -308,19 +503,22 @@ class UniversalDiTBlock(nn.Module):
         super().__init__()
         self.hidden_size = config.hidden_size
         
-        # Normalization layers
+        # Normalization layers, modulated by the shared AdaLN projection
         self.norm1 = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.norm2 = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.norm3 = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         
-        # Adaptive layer norms with timestep conditioning
-        self.ada_ln1 = AdaLN(config.hidden_size, config.hidden_size)
-        self.ada_ln2 = AdaLN(config.hidden_size, config.hidden_size)
-        self.ada_ln3 = AdaLN(config.hidden_size, config.hidden_size)
+        # Single DiT-style timestep modulation: (shift, scale) for all 3 sub-layers in one GEMM
+        self.adaLN_modulation = nn.Sequential(
+            nn.SiLU(),
+            nn.Linear(config.hidden_size, 6 * config.hidden_size, bias=True)
+        )
+        nn.init.zeros_(self.adaLN_modulation[-1].weight)
+        nn.init.zeros_(self.adaLN_modulation[-1].bias)
         
         # Attention layers
         self.self_attn = UniversalAttention(config)
-        self.cross_attn = UniversalAttention(config)
+        self.cross_attn = UniversalAttention(config, is_cross_attention=True)
         
         # MLP
         self.mlp = UniversalMLP(config)
@@ -330,39 +528,65 @@ class UniversalDiTBlock(nn.Module):
         nn.init.xavier_uniform_(self.conditioning_proj.weight, gain=0.5)
         nn.init.zeros_(self.conditioning_proj.bias)
 
+    def compute_modulation(self, timestep_emb: torch.Tensor, pre_activated: bool = False) -> torch.Tensor:
+        """Project timestep embedding to (shift, scale) for all sub-layers: [B, 1, 6 * hidden]"""
+        if pre_activated:
+            # SiLU already applied by the caller (shared across blocks)
+            modulation = self.adaLN_modulation[-1](timestep_emb)
+        else:
+            modulation = self.adaLN_modulation(timestep_emb)
+        return modulation.unsqueeze(1)
+
     def forward(
         self, 
         hidden_states: torch.Tensor,      # Input in hidden space
         conditioning_states: torch.Tensor, # EVA conditioning [B, N, 4096] or [B, N, 4096]
-        timestep_emb: torch.Tensor        # Timestep embedding
+        timestep_emb: torch.Tensor,       # Timestep embedding
+        modulation: Optional[torch.Tensor] = None,  # Precomputed compute_modulation() output
+        projected_conditioning: Optional[torch.Tensor] = None,  # Precomputed conditioning_proj() output
+        cross_attn_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # Precomputed cross-attn K/V
     ) -> torch.Tensor:
+        # Timestep modulation for all sub-layers, broadcast over tokens
+        if modulation is None:
+            modulation = self.compute_modulation(timestep_emb)
+        shift1, scale1, shift2, scale2, shift3, scale3 = modulation.chunk(6, dim=-1)
+        
         # Self-attention with timestep conditioning
         residual = hidden_states
-        hidden_states = self.norm1(hidden_states)
-        hidden_states = self.ada_ln1(hidden_states, timestep_emb)
+        hidden_states = modulate(self.norm1(hidden_states), shift1, scale1)
         hidden_states = self.self_attn(hidden_states)
         hidden_states = residual + hidden_states
         
         # Cross-attention with conditioning (EVA for both tasks)
         residual = hidden_states
-        hidden_states = self.norm2(hidden_states)
-        hidden_states = self.ada_ln2(hidden_states, timestep_emb)
+        hidden_states = modulate(self.norm2(hidden_states), shift2, scale2)
         
         # Project conditioning to hidden dimension (flexible for EVA size)
-        conditioning = self.conditioning_proj(conditioning_states)
-        hidden_states = self.cross_attn(hidden_states, key_value_states=conditioning)
+        if projected_conditioning is None and cross_attn_kv is None:
+            projected_conditioning = self.conditioning_proj(conditioning_states)
+        hidden_states = self.cross_attn(
+            hidden_states, key_value_states=projected_conditioning, cached_kv=cross_attn_kv
+        )
         hidden_states = residual + hidden_states
         
         # MLP
         residual = hidden_states
-        hidden_states = self.norm3(hidden_states)
-        hidden_states = self.ada_ln3(hidden_states, timestep_emb)
+        hidden_states = modulate(self.norm3(hidden_states), shift3, scale3)
         hidden_states = self.mlp(hidden_states)
         hidden_states = residual + hidden_states
         
         return hidden_states
 
 
+@maybe_compile(dynamic=True)
+def spherical_step(x: torch.Tensor, dt: torch.Tensor, prediction: torch.Tensor) -> torch.Tensor:
+    """Euler step followed by projection back onto the unit sphere, fused into one kernel.
+    
+    dt is a 0-d tensor: a Python float would be specialized and recompile for every step size.
+    """
+    return F.normalize(x + dt * prediction, p=2, dim=-1)
+
+
 class UniversalDiTModel(PreTrainedModel):
     """Universal DiT Model for both EVA and CLIP denoising tasks"""
     
@@ -373,6 +597,8 @@ class UniversalDiTModel(PreTrainedModel):
         super().__init__(config)
         self.config = config
         self.gradient_checkpointing = False
+        # Captured denoise step graphs, keyed on input shapes/dtypes (see _get_step_graph)
+        self._cuda_graph_cache = {}
         
         # Task-specific input projection
         self.input_proj = nn.Linear(config.input_embedding_size, config.hidden_size, bias=True)
@@ -387,6 +613,11 @@ class UniversalDiTModel(PreTrainedModel):
         self.blocks = nn.ModuleList([
             UniversalDiTBlock(config) for _ in range(config.num_hidden_layers)
         ])
+        if not getattr(config, "compile_kernels", True):
+            set_torch_compile_enabled(False)
+            logger.info("torch.compile disabled (compile_kernels=False)")
+        if getattr(config, "use_torch_compile", False):
+            self._compile_blocks()
         
         # Output layers
         self.output_norm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
@@ -448,6 +679,27 @@ class UniversalDiTModel(PreTrainedModel):
             nn.init.xavier_uniform_(self.output_proj.weight, gain=0.1)
             nn.init.zeros_(self.output_proj.bias)
 
+    def _compile_blocks(self):
+        """Compile each DiT block in place to fuse its elementwise tails and cut kernel launches"""
+        if not _COMPILE_SETTINGS["enabled"]:
+            logger.warning("torch.compile is disabled, running blocks in eager mode")
+            return
+        if not hasattr(nn.Module, "compile"):
+            logger.warning("nn.Module.compile requires PyTorch 2.2+, running blocks in eager mode")
+            return
+        
+        try:
+            import torch._inductor.config as inductor_config
+            inductor_config.coordinate_descent_tuning = True
+            inductor_config.conv_1x1_as_mm = True
+        except (ImportError, AttributeError) as e:
+            logger.warning(f"Could not set inductor options: {e}")
+        
+        # In-place compile keeps parameter names (no _orig_mod prefix) so checkpoints stay compatible
+        for block in self.blocks:
+            block.compile(dynamic=True, fullgraph=False)
+        logger.info(f"Compiled {len(self.blocks)} DiT blocks with torch.compile")
+
     def gradient_checkpointing_enable(self, gradient_checkpointing_kwargs=None):
         self.gradient_checkpointing = True
 
@@ -460,14 +712,23 @@ class UniversalDiTModel(PreTrainedModel):
         timestep: torch.Tensor,                # [B] - Flow matching timesteps
         encoder_hidden_states: torch.Tensor,  # [B, N, conditioning_dim] - Conditioning
         return_dict: bool = True,
+        precomputed_conditioning: Optional[List[torch.Tensor]] = None,  # From project_conditioning()
+        cross_attention_kv: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,  # From precompute_cross_attention_kv()
+        skip_input_normalize: bool = False,  # hidden_states already on the unit sphere
         **kwargs
     ) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
         """Forward pass for universal denoising"""
         batch_size, seq_len, _ = hidden_states.shape
         
         # Normalize inputs (critical for spherical flow)
-        hidden_states = F.normalize(hidden_states, p=2, dim=-1)
-        encoder_hidden_states = F.normalize(encoder_hidden_states, p=2, dim=-1)
+        if not skip_input_normalize:
+            hidden_states = F.normalize(hidden_states, p=2, dim=-1)
+        if precomputed_conditioning is None and cross_attention_kv is None:
+            encoder_hidden_states = F.normalize(encoder_hidden_states, p=2, dim=-1)
+        if precomputed_conditioning is None:
+            precomputed_conditioning = [None] * len(self.blocks)
+        if cross_attention_kv is None:
+            cross_attention_kv = [None] * len(self.blocks)
         
         # Project input to hidden dimension (task-specific)
         x = self.input_proj(hidden_states)
@@ -479,14 +740,23 @@ class UniversalDiTModel(PreTrainedModel):
         # Get timestep embeddings
         timestep_emb = self.timestep_embedder(timestep)
         
+        # Precompute every block's timestep modulation up front (SiLU shared across blocks)
+        timestep_act = F.silu(timestep_emb)
+        block_modulations = [
+            block.compute_modulation(timestep_act, pre_activated=True) for block in self.blocks
+        ]
+        
         # Pass through transformer blocks
-        for block in self.blocks:
+        for block, modulation, projected_cond, cross_kv in zip(
+            self.blocks, block_modulations, precomputed_conditioning, cross_attention_kv
+        ):
             if self.gradient_checkpointing and self.training:
                 x = torch.utils.checkpoint.checkpoint(
-                    block, x, encoder_hidden_states, timestep_emb, use_reentrant=False
+                    block, x, encoder_hidden_states, timestep_emb, modulation, projected_cond, cross_kv,
+                    use_reentrant=False
                 )
             else:
-                x = block(x, encoder_hidden_states, timestep_emb)
+                x = block(x, encoder_hidden_states, timestep_emb, modulation, projected_cond, cross_kv)
         
         # Output projection (task-specific)
         x = self.output_norm(x)
@@ -502,53 +772,290 @@ class UniversalDiTModel(PreTrainedModel):
             }
         return prediction
     
+    def project_conditioning(self, encoder_hidden_states: torch.Tensor) -> List[torch.Tensor]:
+        """Normalize and project conditioning for every block once, for reuse across forward calls"""
+        encoder_hidden_states = F.normalize(encoder_hidden_states, p=2, dim=-1)
+        return [block.conditioning_proj(encoder_hidden_states) for block in self.blocks]
+    
+    def precompute_cross_attention_kv(
+        self, encoder_hidden_states: torch.Tensor
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Project conditioning through each block's cross-attention K/V once (cached across steps)"""
+        return [
+            block.cross_attn.project_key_value(projected_cond)
+            for block, projected_cond in zip(self.blocks, self.project_conditioning(encoder_hidden_states))
+        ]
+    
     @torch.no_grad()
     def denoise(
         self,
         noisy_embeddings: torch.Tensor,      # [B, N, input_dim] - Noisy CLIP or EVA
         conditioning: torch.Tensor,          # [B, N, conditioning_dim] - EVA conditioning
-        num_inference_steps: int = 50,
+        num_inference_steps: Optional[int] = None,  # Default: 50 (euler) / 25 (heun)
         generator: Optional[torch.Generator] = None,
         return_intermediate: bool = False,
+        autocast_dtype: Optional[torch.dtype] = torch.bfloat16,
+        use_cuda_graph: bool = True,
+        integrator: Literal["euler", "heun"] = "euler",
     ) -> torch.Tensor:
-        """Denoise embeddings using spherical flow matching"""
+        """Denoise embeddings using spherical flow matching (mixed precision on CUDA by default)"""
+        return self._denoise_impl(
+            noisy_embeddings,
+            conditioning,
+            num_inference_steps=num_inference_steps,
+            return_intermediate=return_intermediate,
+            autocast_dtype=autocast_dtype,
+            use_cuda_graph=use_cuda_graph,
+            integrator=integrator,
+        )
+    
+    def denoise_with_grad(
+        self,
+        noisy_embeddings: torch.Tensor,      # [B, N, input_dim] - Noisy CLIP or EVA
+        conditioning: torch.Tensor,          # [B, N, conditioning_dim] - EVA conditioning
+        num_inference_steps: Optional[int] = None,  # Default: 50 (euler) / 25 (heun)
+        return_intermediate: bool = False,
+        gradient_checkpoint_steps: bool = True,
+        autocast_dtype: Optional[torch.dtype] = None,
+        integrator: Literal["euler", "heun"] = "euler",
+    ) -> torch.Tensor:
+        """
+        Differentiable denoising for guidance/reward fine-tuning (DITTO-style).
+        
+        With gradient_checkpoint_steps, each step's forward is recomputed during backward,
+        so memory holds one model call plus the per-step noisy states instead of the full unroll.
+        """
+        return self._denoise_impl(
+            noisy_embeddings,
+            conditioning,
+            num_inference_steps=num_inference_steps,
+            return_intermediate=return_intermediate,
+            gradient_checkpoint_steps=gradient_checkpoint_steps,
+            autocast_dtype=autocast_dtype,
+            integrator=integrator,
+        )
+    
+    def _capture_step_graph(
+        self,
+        x: torch.Tensor,
+        cross_attention_kv: List[Tuple[torch.Tensor, torch.Tensor]],
+        autocast_ctx,
+    ) -> Optional[Dict[str, Any]]:
+        """Capture one model evaluation on static inputs as a CUDA graph; None on failure"""
+        entry = {
+            "x": x.clone(),
+            "t": torch.ones(x.shape[0], device=x.device, dtype=x.dtype),
+            "cross_attention_kv": [(k.clone(), v.clone()) for k, v in cross_attention_kv],
+        }
+        
+        def model_step() -> torch.Tensor:
+            with autocast_ctx:
+                return self.forward(
+                    hidden_states=entry["x"],
+                    timestep=entry["t"],
+                    encoder_hidden_states=None,  # Unused when cross_attention_kv is given
+                    return_dict=False,
+                    cross_attention_kv=entry["cross_attention_kv"],
+                    skip_input_normalize=True,
+                )
+        
+        try:
+            # One warm-up on a side stream so lazy caches and compiled kernels exist before capture
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                model_step()
+            torch.cuda.current_stream().wait_stream(side_stream)
+            
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                entry["out"] = model_step()
+            entry["graph"] = graph
+            # The graph replays fixed addresses but does not own them: hold every tensor it reads
+            entry["dependencies"] = self._graph_dependencies()
+            return entry
+        except Exception as e:
+            logger.warning(f"CUDA graph capture failed, running denoise eagerly: {e}")
+            return None
+    
+    def _get_step_graph(
+        self,
+        x: torch.Tensor,
+        cross_attention_kv: List[Tuple[torch.Tensor, torch.Tensor]],
+        autocast_ctx,
+        autocast_dtype: Optional[torch.dtype],
+    ) -> Optional[Dict[str, Any]]:
+        """Return the cached step graph for these input shapes, capturing it on first use"""
+        key = (
+            tuple(x.shape), x.dtype, x.device, autocast_dtype,
+            tuple((tuple(k.shape), k.dtype, tuple(v.shape), v.dtype) for k, v in cross_attention_kv),
+        )
+        entry = self._cuda_graph_cache.get(key)
+        if entry is not None and not self._graph_dependencies_valid(entry):
+            # Parameters were replaced or RoPE tables rebuilt since capture: the graph reads stale tensors
+            del self._cuda_graph_cache[key]
+            entry = None
+        if entry is not None:
+            # Cross-attention K/V are graph inputs: refresh them with this call's conditioning
+            for (static_k, static_v), (k, v) in zip(entry["cross_attention_kv"], cross_attention_kv):
+                static_k.copy_(k)
+                static_v.copy_(v)
+            return entry
+        
+        entry = self._capture_step_graph(x, cross_attention_kv, autocast_ctx)
+        if entry is not None:
+            if len(self._cuda_graph_cache) >= CUDA_GRAPH_CACHE_SIZE:
+                # Evict the oldest capture (and its memory pool)
+                self._cuda_graph_cache.pop(next(iter(self._cuda_graph_cache)))
+            self._cuda_graph_cache[key] = entry
+        return entry
+    
+    def _graph_dependencies(self) -> Dict[str, List[torch.Tensor]]:
+        """Tensors a captured step graph reads besides its static inputs"""
+        cast_tensors = []
+        for module in self.modules():
+            if isinstance(module, RotaryEmbedding):
+                for cos, sin in module._cast_cache.values():
+                    cast_tensors += [cos, sin]
+        return {
+            "state": list(self.parameters()) + list(self.buffers()),
+            "rope_casts": cast_tensors,
+        }
+    
+    def _graph_dependencies_valid(self, entry: Dict[str, Any]) -> bool:
+        """Whether every tensor captured in the graph is still the one the model uses"""
+        current = self._graph_dependencies()
+        captured = entry["dependencies"]
+        if len(current["state"]) != len(captured["state"]) or any(
+            a is not b for a, b in zip(current["state"], captured["state"])
+        ):
+            return False
+        # RoPE casts are filled lazily per dtype, so captured ones only need to still be present
+        current_casts = {id(t) for t in current["rope_casts"]}
+        return all(id(t) in current_casts for t in captured["rope_casts"])
+    
+    def clear_cuda_graph_cache(self):
+        """Drop captured denoise graphs (they reference the current parameter storage)"""
+        self._cuda_graph_cache = {}
+    
+    def train(self, mode: bool = True):
+        # Captured graphs hold private memory pools: release them when training resumes after eval
+        if mode:
+            self.clear_cuda_graph_cache()
+        return super().train(mode)
+    
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting parameters invalidates the addresses baked into captured graphs
+        self.clear_cuda_graph_cache()
+        return super()._apply(fn, *args, **kwargs)
+    
+    def _denoise_impl(
+        self,
+        noisy_embeddings: torch.Tensor,
+        conditioning: torch.Tensor,
+        num_inference_steps: Optional[int] = None,
+        return_intermediate: bool = False,
+        gradient_checkpoint_steps: bool = False,
+        autocast_dtype: Optional[torch.dtype] = None,
+        use_cuda_graph: bool = False,
+        integrator: str = "euler",
+    ) -> torch.Tensor:
+        """Spherical flow matching sampling loop shared by denoise and denoise_with_grad"""
+        if integrator not in ("euler", "heun"):
+            raise ValueError(f"integrator must be 'euler' or 'heun', got {integrator}")
+        if integrator == "heun" and self.config.prediction_type == "target":
+            raise ValueError("integrator='heun' requires a velocity model, got prediction_type='target'")
+        # Heun costs two model calls per step, so it defaults to half the steps
+        if num_inference_steps is None:
+            num_inference_steps = 25 if integrator == "heun" else 50
+        
         device = noisy_embeddings.device
         batch_size, num_tokens, _ = noisy_embeddings.shape
         
-        # Ensure inputs are normalized
+        # Ensure inputs are normalized (conditioning is normalized once in precompute_cross_attention_kv)
         x = F.normalize(noisy_embeddings, p=2, dim=-1)
-        conditioning = F.normalize(conditioning, p=2, dim=-1)
+        
+        # Model calls run under autocast on CUDA; integration and normalization stay in the input dtype (fp32)
+        use_autocast = autocast_dtype is not None and device.type == "cuda"
+        if use_autocast and autocast_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+            autocast_dtype = torch.float16
+        # Each weight is cast once per forward anyway; the autocast cache is also incompatible with graph capture
+        autocast_ctx = (
+            torch.autocast(device_type="cuda", dtype=autocast_dtype, cache_enabled=False)
+            if use_autocast else nullcontext()
+        )
+        
+        # Conditioning is constant across steps: compute every block's cross-attention K/V once
+        with autocast_ctx:
+            cross_attention_kv = self.precompute_cross_attention_kv(conditioning)
+        
+        def model_step(x_in: torch.Tensor, t_in: torch.Tensor) -> torch.Tensor:
+            with autocast_ctx:
+                if gradient_checkpoint_steps and torch.is_grad_enabled():
+                    return torch.utils.checkpoint.checkpoint(
+                        self.forward, x_in, t_in, conditioning,
+                        use_reentrant=False,
+                        return_dict=False,
+                        cross_attention_kv=cross_attention_kv,
+                        skip_input_normalize=True,
+                    )
+                return self.forward(
+                    hidden_states=x_in,
+                    timestep=t_in,
+                    encoder_hidden_states=conditioning,
+                    return_dict=False,
+                    cross_attention_kv=cross_attention_kv,
+                    skip_input_normalize=True,
+                )
+        
+        # Shapes and dtypes are fixed across steps: replay a captured graph instead of relaunching kernels.
+        # The graph is cached across calls; Heun replays it for both of its evaluations.
+        num_model_calls = num_inference_steps * (2 if integrator == "heun" else 1)
+        step_graph = None
+        if (
+            use_cuda_graph and device.type == "cuda" and not self.training
+            and not torch.is_grad_enabled() and num_model_calls >= CUDA_GRAPH_MIN_MODEL_CALLS
+        ):
+            step_graph = self._get_step_graph(
+                x, cross_attention_kv, autocast_ctx, autocast_dtype if use_autocast else None
+            )
+        
+        def evaluate(x_in: torch.Tensor, t: float) -> torch.Tensor:
+            """Model prediction at (x_in, t), returned as a fresh tensor in the state dtype"""
+            if step_graph is not None:
+                step_graph["x"].copy_(x_in)
+                step_graph["t"].fill_(t)
+                step_graph["graph"].replay()
+                # Copy out: the next replay overwrites the static output
+                return step_graph["out"].to(x_in.dtype, copy=True)
+            t_batch = torch.full((batch_size,), t, device=device, dtype=x_in.dtype)
+            return model_step(x_in, t_batch).to(x_in.dtype)
         
         # Reverse process (t=1 to t=0)
         dt = 1.0 / num_inference_steps
+        dt_tensor = torch.tensor(dt, device=device, dtype=x.dtype)
+        half_dt_tensor = torch.tensor(0.5 * dt, device=device, dtype=x.dtype)
         
         intermediate_states = []
         
         for i in range(num_inference_steps):
             t = 1.0 - i * dt
-            t_batch = torch.full((batch_size,), t, device=device, dtype=x.dtype)
             
             # Get model prediction
-            output = self.forward(
-                hidden_states=x,
-                timestep=t_batch,
-                encoder_hidden_states=conditioning,
-                return_dict=True
-            )
-            prediction = output["prediction"]
+            prediction = evaluate(x, t)
             
-            if self.config.prediction_type == "velocity":
-                # Integrate velocity
-                x = x + dt * prediction
-            elif self.config.prediction_type == "target":
+            # Update state and keep it on the sphere
+            if self.config.prediction_type == "target":
                 # Direct target prediction
-                x = prediction
+                x = F.normalize(prediction, p=2, dim=-1)
+            elif integrator == "heun":
+                # Heun: Euler predictor, then average the velocities at both ends of the step
+                x_pred = spherical_step(x, dt_tensor, prediction)
+                prediction_next = evaluate(x_pred, t - dt)
+                x = spherical_step(x, half_dt_tensor, prediction + prediction_next)
             else:
-                # Custom integration
-                x = x + dt * prediction
-            
-            # Ensure result stays on sphere
-            x = F.normalize(x, p=2, dim=-1)
+                # Integrate velocity and renormalize in one fused kernel (also used for custom types)
+                x = spherical_step(x, dt_tensor, prediction)
             
             if return_intermediate:
                 intermediate_states.append(x.clone())